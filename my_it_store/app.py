@@ -1,21 +1,85 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from markupsafe import Markup
+from flask_session import Session
+import pylibmc
+from redis.exceptions import RedisError
+from sqlalchemy import event, func, insert, or_, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import selectinload
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 import os
 import re
 from datetime import datetime, timedelta
 import secrets
-from functools import wraps
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, "instance", "employee.db")
+SALES_PER_PAGE = 50
+
+# pylibmc client ใช้ร่วมกันข้าม thread ไม่ได้ จึงให้แต่ละ thread clone client ของตัวเอง
+class ThreadLocalMemcachedClient:
+    def __init__(self, servers):
+        self._master = pylibmc.Client(servers, binary=True)
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._master.clone()
+        return getattr(client, name)
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
-app.config["SECRET_KEY"] = secrets.token_hex(16)
+# ใช้ connection แบบถาวรใน pool เพื่อให้ page cache ของ SQLite ไม่ต้องเริ่มใหม่ทุก request
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": 5,
+    "max_overflow": 10,
+    "connect_args": {"check_same_thread": False},
+}
+# ต้องตั้ง SECRET_KEY ใน production ไม่เช่นนั้นแต่ละ worker จะสุ่ม key ของตัวเอง
+# ทำให้ session id ที่เซ็นจาก worker หนึ่งใช้กับอีก worker ไม่ได้ และทุกครั้งที่ deploy ผู้ใช้จะถูก logout
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY") or secrets.token_hex(16)
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(hours=24)
+app.config["SESSION_TYPE"] = "memcached"
+app.config["SESSION_USE_SIGNER"] = True
+app.config["SESSION_MEMCACHED"] = ThreadLocalMemcachedClient(
+    [os.environ.get("MEMCACHED_SERVER", "127.0.0.1:11211")]
+)
 
 db = SQLAlchemy(app)
+Session(app)
+cache = Cache(app, config={
+    "CACHE_TYPE": "RedisCache",
+    "CACHE_REDIS_URL": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+})
+ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# การ hash หลายตัวพร้อมกันบนหลาย core มาจาก argon2 ที่ปล่อย GIL ร่วมกับ worker/thread ของ gunicorn
+# ไม่ได้มาจาก pool นี้ (request thread ยังรอผลอยู่) pool มีไว้จำกัดจำนวน hash ที่รันพร้อมกัน
+# ต่อ process เพื่อคุมหน่วยความจำ (~19 MiB ต่อ hash) เพราะมีหลาย worker อยู่แล้วจึงตั้งไว้ค่าน้อย
+HASH_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("HASH_POOL_WORKERS", 2)))
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=134217728")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    # ให้ SQLite เก็บสถิติของ index ให้ planner ใช้ (ทำงานเฉพาะเมื่อจำเป็น)
+    cursor.execute("PRAGMA optimize=0x10002")
+    cursor.close()
 
 class Employee(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -27,12 +91,24 @@ class Employee(db.Model):
     phone = db.Column(db.String(10), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    sales = db.relationship("Sale", back_populates="employee", lazy="select")
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = HASH_POOL.submit(ph.hash, password).result()
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith("$argon2"):
+            # hash เดิมที่สร้างด้วย Werkzeug (PBKDF2)
+            return check_password_hash(self.password_hash, password)
+        try:
+            return HASH_POOL.submit(ph.verify, self.password_hash, password).result()
+        except (VerifyMismatchError, InvalidHashError):
+            return False
+
+    def needs_rehash(self):
+        if not self.password_hash.startswith("$argon2"):
+            return True
+        return ph.check_needs_rehash(self.password_hash)
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -43,6 +119,7 @@ class Product(db.Model):
     category = db.Column(db.String(50))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    sales = db.relationship("Sale", back_populates="product", lazy="select")
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -51,35 +128,105 @@ class Sale(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
     sale_date = db.Column(db.DateTime, default=datetime.utcnow)
-    product = db.relationship("Product", backref="sales")
-    employee = db.relationship("Employee", backref="sales")
+    product = db.relationship("Product", back_populates="sales")
+    employee = db.relationship("Employee", back_populates="sales")
+
+    __table_args__ = (
+        db.Index("ix_sale_date_desc", sale_date.desc()),
+        db.Index("ix_sale_employee", "employee_id"),
+        db.Index("ix_sale_product", "product_id"),
+    )
+
+_HAS_LOWER = re.compile("[a-z]").search
+_HAS_UPPER = re.compile("[A-Z]").search
+_HAS_DIGIT = re.compile("[0-9]").search
 
 def validate_password(password):
     if len(password) < 8:
         return False, "รหัสผ่านต้องมีอย่างน้อย 8 ตัวอักษร"
-    if not re.search("[a-z]", password):
+    if not _HAS_LOWER(password):
         return False, "รหัสผ่านต้องมีตัวพิมพ์เล็ก"
-    if not re.search("[A-Z]", password):
+    if not _HAS_UPPER(password):
         return False, "รหัสผ่านต้องมีตัวพิมพ์ใหญ่"
-    if not re.search("[0-9]", password):
+    if not _HAS_DIGIT(password):
         return False, "รหัสผ่านต้องมีตัวเลข"
     return True, "รหัสผ่านปลอดภัย"
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if "username" not in session:
-            flash("กรุณาเข้าสู่ระบบก่อน", "error")
-            return redirect(url_for("login"))
-        return f(*args, **kwargs)
-    return decorated_function
+@cache.memoize(60)
+def _all_products():
+    # เก็บเป็น dict แทน ORM object เพื่อให้ใช้ได้หลัง session ปิด
+    rows = db.session.execute(
+        select(Product.id, Product.name, Product.price, Product.stock, Product.category)
+    ).all()
+    return [dict(row._mapping) for row in rows]
+
+# Redis ล่มต้องไม่ทำให้หน้าเว็บ error ให้อ่านจากฐานข้อมูลแทน
+def _cache_get(key):
+    try:
+        return cache.get(key)
+    except RedisError:
+        app.logger.warning("cache get failed for %s", key, exc_info=True)
+        return None
+
+def _cache_set(key, value, timeout=None):
+    try:
+        cache.set(key, value, timeout=timeout)
+    except RedisError:
+        app.logger.warning("cache set failed for %s", key, exc_info=True)
+
+def _recent_sales():
+    recent_sales = _cache_get("recent_sales")
+    if recent_sales is None:
+        sales = Sale.query.options(selectinload(Sale.product)).order_by(Sale.sale_date.desc()).limit(5).all()
+        recent_sales = [
+            {"product_name": s.product.name, "quantity": s.quantity, "total_price": s.total_price}
+            for s in sales
+        ]
+        _cache_set("recent_sales", recent_sales, timeout=30)
+    return recent_sales
+
+def _product_options_html():
+    html = _cache_get("product_options_html")
+    if html is None:
+        products = db.session.execute(
+            select(Product.id, Product.name, Product.price, Product.stock)
+        ).all()
+        html = render_template("_product_options.html", products=products)
+        _cache_set("product_options_html", html)
+    return Markup(html)
+
+def _sales_grand_total():
+    grand_total = _cache_get("sales_grand_total")
+    if grand_total is None:
+        grand_total = db.session.execute(select(func.coalesce(func.sum(Sale.total_price), 0))).scalar()
+        _cache_set("sales_grand_total", grand_total)
+    return grand_total
+
+def invalidate_cache():
+    # เรียกหลัง commit แล้ว ถ้าลบ cache ไม่ได้ก็แค่ log ไว้ ข้อมูลเก่าจะหมดอายุตาม timeout
+    try:
+        cache.delete_memoized(_all_products)
+        cache.delete("recent_sales")
+        cache.delete("product_options_html")
+        cache.delete("sales_grand_total")
+    except RedisError:
+        app.logger.warning("cache invalidation failed", exc_info=True)
+
+PUBLIC_ENDPOINTS = frozenset({"login", "register", "logout", "static"})
+
+@app.before_request
+def require_login():
+    if request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    if "username" not in session or "employee_id" not in session:
+        flash("กรุณาเข้าสู่ระบบก่อน", "error")
+        return redirect(url_for("login"))
 
 @app.route("/")
-@login_required
 def home():
-    employee = Employee.query.filter_by(username=session["username"]).first()
-    products = Product.query.all()
-    recent_sales = Sale.query.order_by(Sale.sale_date.desc()).limit(5).all()
+    employee = db.session.get(Employee, session["employee_id"])
+    products = _all_products()
+    recent_sales = _recent_sales()
     return render_template("dashboard.html", employee=employee, products=products, recent_sales=recent_sales)
 
 @app.route("/login", methods=["GET", "POST"])
@@ -89,7 +236,10 @@ def login():
         password = request.form["password"]
         employee = Employee.query.filter_by(username=username).first()
         if employee and employee.check_password(password):
+            if employee.needs_rehash():
+                employee.set_password(password)
             session["username"] = username
+            session["employee_id"] = employee.id
             session.permanent = True
             employee.last_login = datetime.utcnow()
             db.session.commit()
@@ -119,11 +269,15 @@ def register():
             flash("รหัสผ่านไม่ตรงกัน!", "error")
             return redirect(url_for("register"))
 
-        if Employee.query.filter_by(username=username).first():
+        # ตรวจซ้ำด้วย query เดียวก่อน hash รหัสผ่าน ซึ่งกิน CPU และหน่วยความจำมาก
+        existing = db.session.execute(
+            select(Employee.username, Employee.email)
+            .where(or_(Employee.username == username, Employee.email == email))
+        ).all()
+        if any(row.username == username for row in existing):
             flash("ชื่อผู้ใช้นี้มีคนใช้แล้ว!", "error")
             return redirect(url_for("register"))
-
-        if Employee.query.filter_by(email=email).first():
+        if existing:
             flash("อีเมลนี้มีคนใช้แล้ว!", "error")
             return redirect(url_for("register"))
 
@@ -137,19 +291,30 @@ def register():
         new_employee.set_password(password)
         
         db.session.add(new_employee)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            # กรณีมีคนสมัครชื่อเดียวกันพร้อมกันหลังผ่านการตรวจด้านบน
+            db.session.rollback()
+            if "employee.username" in str(e.orig):
+                flash("ชื่อผู้ใช้นี้มีคนใช้แล้ว!", "error")
+            elif "employee.email" in str(e.orig):
+                flash("อีเมลนี้มีคนใช้แล้ว!", "error")
+            else:
+                raise
+            return redirect(url_for("register"))
         flash("ลงทะเบียนสำเร็จ!", "success")
         return redirect(url_for("login"))
     return render_template("register.html")
 
 @app.route("/products")
-@login_required
 def products():
-    products = Product.query.all()
+    products = db.session.execute(
+        select(Product.id, Product.name, Product.description, Product.price, Product.stock, Product.category)
+    ).all()
     return render_template("products.html", products=products)
 
 @app.route("/product/add", methods=["GET", "POST"])
-@login_required
 def add_product():
     if request.method == "POST":
         new_product = Product(
@@ -161,12 +326,12 @@ def add_product():
         )
         db.session.add(new_product)
         db.session.commit()
+        invalidate_cache()
         flash("เพิ่มสินค้าสำเร็จ!", "success")
         return redirect(url_for("products"))
     return render_template("add_product.html")
 
 @app.route("/product/edit/<int:id>", methods=["GET", "POST"])
-@login_required
 def edit_product(id):
     product = Product.query.get_or_404(id)
     if request.method == "POST":
@@ -176,71 +341,85 @@ def edit_product(id):
         product.stock = int(request.form["stock"])
         product.category = request.form["category"]
         db.session.commit()
+        invalidate_cache()
         flash("อัพเดทสินค้าสำเร็จ!", "success")
         return redirect(url_for("products"))
     return render_template("edit_product.html", product=product)
 
 @app.route("/product/delete/<int:id>")
-@login_required
 def delete_product(id):
     product = Product.query.get_or_404(id)
     db.session.delete(product)
     db.session.commit()
+    invalidate_cache()
     flash("ลบสินค้าสำเร็จ!", "success")
     return redirect(url_for("products"))
 
 @app.route("/sales")
-@login_required
 def sales():
-    sales = Sale.query.order_by(Sale.sale_date.desc()).all()
-    return render_template("sales.html", sales=sales)
+    page = request.args.get("page", 1, type=int)
+    pagination = Sale.query.options(
+        selectinload(Sale.product), selectinload(Sale.employee)
+    ).order_by(Sale.sale_date.desc()).paginate(page=page, per_page=SALES_PER_PAGE, error_out=False)
+    grand_total = _sales_grand_total()
+    return render_template("sales.html", sales=pagination.items, pagination=pagination, grand_total=grand_total)
 
 @app.route("/sale/add", methods=["GET", "POST"])
-@login_required
 def add_sale():
     if request.method == "POST":
         product_id = int(request.form["product_id"])
         quantity = int(request.form["quantity"])
-        product = Product.query.get_or_404(product_id)
-        employee = Employee.query.filter_by(username=session["username"]).first()
+        # ตัดสต็อกแบบ atomic เพื่อกันการขายซ้อนกันจนสต็อกติดลบ
+        updated = db.session.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.stock >= quantity)
+            .values(stock=Product.stock - quantity)
+        ).rowcount
         
-        if product.stock < quantity:
+        if updated == 0:
+            db.session.rollback()
+            if db.session.get(Product, product_id) is None:
+                abort(404)
             flash("สินค้าในสต็อกไม่เพียงพอ!", "error")
             return redirect(url_for("add_sale"))
         
-        total_price = product.price * quantity
-        new_sale = Sale(
-            product_id=product_id,
-            employee_id=employee.id,
-            quantity=quantity,
-            total_price=total_price
+        price = db.session.execute(select(Product.price).where(Product.id == product_id)).scalar()
+        total_price = price * quantity
+        db.session.execute(
+            insert(Sale).values(
+                product_id=product_id,
+                employee_id=session["employee_id"],
+                quantity=quantity,
+                total_price=total_price
+            )
         )
-        
-        product.stock -= quantity
-        db.session.add(new_sale)
         db.session.commit()
+        invalidate_cache()
         flash("บันทึกการขายสำเร็จ!", "success")
         return redirect(url_for("sales"))
     
-    products = Product.query.all()
-    return render_template("add_sale.html", products=products)
+    return render_template("add_sale.html", product_options=_product_options_html())
 
 @app.route("/logout")
 def logout():
     session.pop("username", None)
+    session.pop("employee_id", None)
     flash("ออกจากระบบสำเร็จ!", "success")
     return redirect(url_for("login"))
 
-# สร้างฐานข้อมูลถ้ายังไม่มี
-if not os.path.exists(os.path.dirname(db_path)):
-    os.makedirs(os.path.dirname(db_path))
-
-with app.app_context():
+# สร้างฐานข้อมูลด้วยคำสั่ง `flask init-db` (รันครั้งเดียวก่อนเริ่ม server)
+@app.cli.command("init-db")
+def init_db():
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
     if not os.path.exists(db_path):
         db.create_all()
         print(f"Database created at {db_path}")
     else:
+        # ฐานข้อมูลเดิมยังไม่มี index ของตาราง sale
+        for index in Sale.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
         print(f"Using existing database at {db_path}")
 
-if _name_ == "_main_":
+# server ของ Werkzeug ใช้สำหรับพัฒนาเท่านั้น production ให้รันผ่าน gunicorn (ดู README)
+if __name__ == "__main__" and os.environ.get("FLASK_ENV") == "development":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))